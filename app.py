@@ -1,12 +1,54 @@
+import io
 import os
-import json
+import atexit
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import requests
 import tempfile
 import mimetypes
 import google.generativeai as genai
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+from cachetools import TTLCache
+from PIL import Image, ImageOps
+from google.api_core import exceptions as google_exceptions
+from googleapiclient.errors import HttpError
 from flask import Flask, request, jsonify, render_template
+from flask.json.provider import JSONProvider
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+class OrjsonProvider(JSONProvider):
+    """Serve (and parse) JSON with orjson; bills can carry hundreds of items."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Behind a reverse proxy remote_addr is the proxy itself. Set TRUSTED_PROXY_HOPS
+# to the number of proxies in front of the app so rate limits key on the real
+# client address; leave it at 0 when clients connect directly, otherwise they
+# could dodge the limits with a forged X-Forwarded-For header.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+# Per-client rate limits (in-memory, so counted per worker process)
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    default_limits=["30/minute"],
+    storage_uri="memory://",
+)
 
 # --- CONFIGURATION ---
 API_KEY = os.getenv("GOOGLE_API_KEY") 
@@ -16,6 +58,72 @@ if not API_KEY:
 else:
     genai.configure(api_key=API_KEY)
 
+# Download settings: (connect, read) timeout in seconds and a 64 KiB buffer
+DOWNLOAD_TIMEOUT = (5, 30)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Documents up to this size are sent to Gemini inline; larger ones (or ones of
+# unknown size) go through a temp file and the File API
+INLINE_DATA_LIMIT = 20_000_000
+
+# Downloads are rejected from their headers alone when they are clearly not a
+# bill (e.g. an HTML login page) or too large to process. Generic binary types
+# are let through and identified from the URL suffix instead.
+DOCUMENT_MIME_TYPES = {'application/pdf', 'image/jpeg', 'image/png', 'image/webp'}
+GENERIC_MIME_TYPES = {'', 'application/octet-stream', 'binary/octet-stream'}
+# Common non-standard spellings some hosts send, mapped to the real type
+MIME_TYPE_ALIASES = {
+    'image/jpg': 'image/jpeg',
+    'image/pjpeg': 'image/jpeg',
+    'image/x-png': 'image/png',
+    'application/x-pdf': 'application/pdf',
+    'application/acrobat': 'application/pdf',
+}
+MAX_DOCUMENT_SIZE = 50_000_000
+
+# Batch endpoint: documents per request and how many are processed at once.
+# The whole batch runs inside one request, so it answers after
+# BATCH_DEADLINE_SECONDS with whatever has finished; this must stay below
+# gunicorn's --timeout (Dockerfile) or the worker is killed and all is lost.
+BATCH_MAX_DOCUMENTS = 8
+BATCH_WORKERS = 4
+BATCH_DEADLINE_SECONDS = 150
+
+# Temp files for oversized documents (20-50 MB each) use the system temp dir.
+# Set APP_TMPDIR=/dev/shm to keep them in RAM instead, but only with enough
+# shared memory for several at once: Docker's default /dev/shm is 64 MB.
+def pick_temp_dir():
+    candidate = os.environ.get('APP_TMPDIR')
+    if not candidate:
+        return None
+    if os.path.isdir(candidate) and os.access(candidate, os.W_OK | os.X_OK):
+        return candidate
+    print(f"⚠️ WARNING: Temp dir {candidate} not writable, using system default.")
+    return None
+
+tempfile.tempdir = pick_temp_dir()
+
+# Shared HTTP session: keeps TCP/TLS connections alive between downloads and
+# retries transient failures (429/5xx) with exponential backoff
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    # raise_on_status=False: once retries run out, hand back the last response
+    # so the usual status check reports "Download failed" instead of a RetryError.
+    # respect_retry_after_header=False: the host is user-supplied, and urllib3
+    # would sleep for whatever Retry-After it sends; use our short backoff only.
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        raise_on_status=False,
+        respect_retry_after_header=False,
+    ),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
 # --- GEMINI SETUP ---
 generation_config = {
     "temperature": 0.0,
@@ -24,8 +132,10 @@ generation_config = {
     "response_mime_type": "application/json",
 }
 
+MODEL_NAME = "gemini-2.0-flash-lite"
+
 model = genai.GenerativeModel(
-    model_name="gemini-2.0-flash-lite", 
+    model_name=MODEL_NAME, 
     generation_config=generation_config,
 )
 
@@ -70,28 +180,159 @@ EXTRACTION RULES:
    - Do not extract a "Total" line as an item.
 """
 
-def process_with_gemini(file_path, mime_type):
+def warm_up():
+    # Pay the TLS handshake and credential setup before the first user request.
+    # Runs in the background so a slow or failing API never blocks boot.
+    try:
+        list(genai.list_models())
+    except Exception as e:
+        print(f"⚠️ WARNING: Gemini warm-up failed: {e}")
+
+if API_KEY:
+    threading.Thread(target=warm_up, daemon=True).start()
+
+# --- GEMINI CONCURRENCY ---
+# Within one worker process, all request threads (gunicorn gthread, see the
+# Dockerfile's --threads) and batch workers share a fixed number of Gemini
+# slots, so bursts queue here instead of tripping the API's 429 rate limit.
+# The cap is per process: the service as a whole runs at most
+# workers x GEMINI_CONCURRENCY calls at once. Rate-limit / unavailable errors
+# that still get through are retried with exponential backoff.
+GEMINI_CONCURRENCY = 4
+GEMINI_RETRIES = 3
+GEMINI_BACKOFF_SECONDS = 1.0
+# How long a request waits for a free slot before giving up with a 503; kept
+# well under gunicorn's worker --timeout so the 503 actually reaches the client
+GEMINI_QUEUE_TIMEOUT = 20
+gemini_slots = threading.BoundedSemaphore(GEMINI_CONCURRENCY)
+
+class GeminiBusy(Exception):
+    pass
+
+def is_retryable(e):
+    # generate_content raises google.api_core errors; genai.upload_file goes
+    # through googleapiclient and raises HttpError instead
+    if isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)):
+        return True
+    return isinstance(e, HttpError) and e.resp.status in (429, 503)
+
+def call_gemini(fn, *args, **kwargs):
+    for attempt in range(GEMINI_RETRIES + 1):
+        if not gemini_slots.acquire(timeout=GEMINI_QUEUE_TIMEOUT):
+            raise GeminiBusy("Server busy, please retry shortly")
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not is_retryable(e) or attempt == GEMINI_RETRIES:
+                raise
+        finally:
+            gemini_slots.release()
+        # Back off without holding a slot
+        time.sleep(GEMINI_BACKOFF_SECONDS * 2 ** attempt)
+
+# --- RESULT CACHE ---
+# Identical documents (UI retries, replayed test URLs) are answered from memory
+# instead of re-running extraction. Keyed by the SHA-256 of the document bytes.
+RESULT_CACHE = TTLCache(maxsize=512, ttl=3600)
+result_cache_lock = threading.Lock()
+
+def document_digest(document):
+    if isinstance(document, bytes):
+        return hashlib.sha256(document).digest()
+    digest = hashlib.sha256()
+    with open(document, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+def process_with_gemini(document, mime_type):
+    """`document` is either the raw bytes (sent inline) or a path to upload."""
+    cache_key = (document_digest(document), mime_type)
+    with result_cache_lock:
+        cached = RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        # Nothing was spent on this call; report that instead of the original usage
+        return {
+            **cached,
+            "cached": True,
+            "token_usage": {name: 0 for name in cached["token_usage"]},
+        }
+
+    result = extract_with_gemini(document, mime_type)
+    with result_cache_lock:
+        RESULT_CACHE[cache_key] = result
+    return {**result, "cached": False}
+
+# Background pool for deleting uploaded Gemini files; drained on shutdown so
+# pending deletes aren't lost when a worker exits
+CLEANUP_POOL = ThreadPoolExecutor(max_workers=4)
+atexit.register(CLEANUP_POOL.shutdown, wait=True)
+
+def safe_delete(uploaded_file):
+    try:
+        uploaded_file.delete()
+    except:
+        pass
+
+# Gemini bills images per 768px tile, so very high-DPI scans cost several
+# times the tokens of a 1600px copy without reading any better
+MAX_IMAGE_SIDE = 1600
+
+def downscale_image(data, mime_type):
+    if not mime_type.startswith('image/'):
+        return data, mime_type
+    try:
+        image = Image.open(io.BytesIO(data))
+        if max(image.size) <= MAX_IMAGE_SIDE:
+            return data, mime_type
+        # Phone photos rely on the EXIF orientation tag, which JPEG re-encoding
+        # drops, so bake the rotation into the pixels first
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ("RGBA", "LA", "P"):
+            # Flatten transparency onto white instead of letting it turn black
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        else:
+            image = image.convert("RGB")
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        return buffer.getvalue(), 'image/jpeg'
+    except Exception:
+        # Not something Pillow can read; let Gemini have the original
+        return data, mime_type
+
+def extract_with_gemini(document, mime_type):
     uploaded_file = None
     try:
-        # Upload
-        uploaded_file = genai.upload_file(file_path, mime_type=mime_type)
+        if isinstance(document, bytes):
+            # Small documents go inline with the request, no File API round trip
+            document, mime_type = downscale_image(document, mime_type)
+            document_part = {"mime_type": mime_type, "data": document}
+        else:
+            # Upload
+            uploaded_file = call_gemini(genai.upload_file, document, mime_type=mime_type)
+            document_part = uploaded_file
         
         # Generate
-        response = model.generate_content([SYSTEM_PROMPT, uploaded_file])
+        response = call_gemini(model.generate_content, [SYSTEM_PROMPT, document_part])
         
         # Parse
         try:
-            ai_data = json.loads(response.text)
+            ai_data = orjson.loads(response.text)
         except:
             cleaned_text = response.text.replace("```json", "").replace("```", "").strip()
-            ai_data = json.loads(cleaned_text)
+            ai_data = orjson.loads(cleaned_text)
         
         # Usage
         usage = response.usage_metadata
         token_usage = {
             "total_tokens": usage.total_token_count,
             "input_tokens": usage.prompt_token_count,
-            "output_tokens": usage.candidates_token_count
+            "output_tokens": usage.candidates_token_count,
+            "cached_tokens": getattr(usage, "cached_content_token_count", 0)
         }
         
         return {
@@ -100,64 +341,164 @@ def process_with_gemini(file_path, mime_type):
             "data": ai_data
         }
     finally:
-        # GOOD PRACTICE: Delete file from Gemini Cloud to avoid clutter/limits
+        # GOOD PRACTICE: Delete file from Gemini Cloud to avoid clutter/limits.
+        # Done off the request path so the client isn't kept waiting on it.
         if uploaded_file:
-            try:
-                uploaded_file.delete()
-            except:
-                pass
+            CLEANUP_POOL.submit(safe_delete, uploaded_file)
 
 # --- ROUTES ---
 
+@app.errorhandler(429)
+def rate_limited(e):
+    # The UI helper route reports failures under "error", the API under "message"
+    key = "error" if request.path == '/analyze-file' else "message"
+    return jsonify({"is_success": False, key: f"Rate limit exceeded: {e.description}"}), 429
+
+def busy_response(e, key="message"):
+    return jsonify({"is_success": False, key: str(e)}), 503, {"Retry-After": str(GEMINI_QUEUE_TIMEOUT)}
+
 @app.route('/')
+@limiter.exempt
 def index():
     return render_template('index.html')
 
-@app.route('/extract-bill-data', methods=['POST'])
-def extract_bill_api():
-    temp_path = None
-    try:
-        data = request.get_json()
-        if not data or 'document' not in data:
-            return jsonify({"is_success": False, "message": "Missing 'document' url"}), 400
-        
-        doc_url = data['document']
-        
-        # Download
-        response = requests.get(doc_url, stream=True)
+class DownloadError(Exception):
+    pass
+
+def iter_limited(response):
+    # Content-Length can be missing (chunked responses) or wrong, so enforce
+    # MAX_DOCUMENT_SIZE on the bytes actually received
+    received = 0
+    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+        received += len(chunk)
+        if received > MAX_DOCUMENT_SIZE:
+            raise DownloadError("Document too large")
+        yield chunk
+
+def download_document(doc_url):
+    """Fetch `doc_url` and return `(document, mime_type)`.
+
+    `document` is the raw bytes for small files, or the path of a temp file
+    (owned by the caller) for oversized ones.
+    """
+    # Download (streamed straight to disk, never buffered whole in memory)
+    with SESSION.get(doc_url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
         if response.status_code != 200:
-            return jsonify({"is_success": False, "message": "Download failed"}), 400
-        
-        # Robust MIME Type Detection
-        content_type = response.headers.get('Content-Type', '')
-        ext = mimetypes.guess_extension(content_type)
+            raise DownloadError("Download failed")
+
+        # Fail fast on the headers, before any of the body is read
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        content_type = MIME_TYPE_ALIASES.get(content_type, content_type)
+        try:
+            content_length = int(response.headers.get('Content-Length') or 0)
+        except ValueError:
+            raise DownloadError("Invalid Content-Length header")
+        if content_type not in DOCUMENT_MIME_TYPES | GENERIC_MIME_TYPES:
+            raise DownloadError(f"Unsupported document type: {content_type}")
+        if content_length > MAX_DOCUMENT_SIZE:
+            raise DownloadError("Document too large")
+
+        # Robust MIME Type Detection (generic binary types say nothing about
+        # the format, e.g. octet-stream guesses '.bin', so go by the URL)
+        ext = None
+        if content_type not in GENERIC_MIME_TYPES:
+            ext = mimetypes.guess_extension(content_type)
         if not ext:
             # Fallback checks if headers fail
-            if '.pdf' in doc_url.lower(): ext = '.pdf'
-            elif '.png' in doc_url.lower(): ext = '.png'
-            elif '.jpg' in doc_url.lower(): ext = '.jpg'
+            lower_url = doc_url.lower()
+            if '.pdf' in lower_url: ext = '.pdf'
+            elif '.png' in lower_url: ext = '.png'
+            elif '.jpg' in lower_url: ext = '.jpg'
             else: ext = '.pdf' # Default
-            
+
         # Determine MIME for Gemini
-        gemini_mime_type = content_type if content_type else 'application/pdf'
+        gemini_mime_type = 'application/pdf' if content_type in GENERIC_MIME_TYPES else content_type
         if ext == '.pdf': gemini_mime_type = 'application/pdf'
         if ext in ['.png', '.jpg', '.jpeg']: gemini_mime_type = 'image/jpeg'
 
+        if 0 < content_length < INLINE_DATA_LIMIT:
+            # Fast path: keep the body in memory and send it inline
+            body = b"".join(iter_limited(response))
+            return body, gemini_mime_type
+
         # Save Temp
         with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as temp_file:
-            temp_file.write(response.content)
-            temp_path = temp_file.name
+            try:
+                for chunk in iter_limited(response):
+                    temp_file.write(chunk)
+            except BaseException:
+                temp_file.close()
+                os.remove(temp_file.name)
+                raise
+        return temp_file.name, gemini_mime_type
 
-        try:
-            result = process_with_gemini(temp_path, gemini_mime_type)
-            return jsonify(result)
-        finally:
-            if os.path.exists(temp_path): os.remove(temp_path)
+def extract_from_url(doc_url):
+    document, mime_type = download_document(doc_url)
+    try:
+        return process_with_gemini(document, mime_type)
+    finally:
+        if isinstance(document, str) and os.path.exists(document):
+            os.remove(document)
 
+@app.route('/extract-bill-data', methods=['POST'])
+@limiter.limit("10/minute")
+def extract_bill_api():
+    try:
+        data = request.get_json()
+        if not data or 'document' not in data:
+            return jsonify({"is_success": False, "message": "Missing 'document' url"}), 400
+
+        return jsonify(extract_from_url(data['document']))
+
+    except DownloadError as e:
+        return jsonify({"is_success": False, "message": str(e)}), 400
+    except GeminiBusy as e:
+        return busy_response(e)
     except Exception as e:
         # Return strict error format
         return jsonify({"is_success": False, "message": str(e)}), 500
 
+@app.route('/extract-bill-batch', methods=['POST'])
+@limiter.limit("2/minute")
+def extract_bill_batch_api():
+    """Extract several documents in one call; results keep the input order."""
+    try:
+        data = request.get_json()
+        documents = data.get('documents') if data else None
+        if not isinstance(documents, list) or not documents:
+            return jsonify({"is_success": False, "message": "Missing 'documents' list"}), 400
+        if not all(isinstance(doc_url, str) for doc_url in documents):
+            return jsonify({"is_success": False, "message": "'documents' must be a list of urls"}), 400
+        if len(documents) > BATCH_MAX_DOCUMENTS:
+            return jsonify({"is_success": False, "message": f"At most {BATCH_MAX_DOCUMENTS} documents per batch"}), 400
+
+        def run(doc_url):
+            try:
+                return extract_from_url(doc_url)
+            except Exception as e:
+                return {"is_success": False, "message": str(e)}
+
+        # Repeated urls are extracted once; concurrent copies would all miss
+        # the result cache and each pay for a Gemini call
+        pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+        futures = {doc_url: pool.submit(run, doc_url) for doc_url in dict.fromkeys(documents)}
+        wait(futures.values(), timeout=BATCH_DEADLINE_SECONDS)
+        # Don't block on stragglers; they finish in the background (and still
+        # fill the result cache) while this request answers in time
+        pool.shutdown(wait=False, cancel_futures=True)
+
+        def outcome(future):
+            if future.done() and not future.cancelled():
+                return future.result()
+            return {"is_success": False, "message": "Timed out, please retry this document"}
+
+        results = [{"document": doc_url, **outcome(futures[doc_url])} for doc_url in documents]
+
+        return jsonify({"is_success": True, "results": results})
+
+    except Exception as e:
+        return jsonify({"is_success": False, "message": str(e)}), 500
+
 @app.route('/analyze-file', methods=['POST'])
 def analyze_file_ui():
     """Helper for UI testing"""
@@ -170,6 +511,9 @@ def analyze_file_ui():
     try:
         mime_type = file.content_type or 'application/pdf'
         ext = mimetypes.guess_extension(mime_type) or ".pdf"
+
+        if request.content_length and request.content_length < INLINE_DATA_LIMIT:
+            return jsonify(process_with_gemini(file.read(), mime_type))
         
         with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as temp_file:
             file.save(temp_file.name)
@@ -180,6 +524,8 @@ def analyze_file_ui():
             return jsonify(result)
         finally:
             if os.path.exists(temp_path): os.remove(temp_path)
+    except GeminiBusy as e:
+        return busy_response(e, key="error")
     except Exception as e:
         return jsonify({"is_success": False, "error": str(e)}), 500
 